@@ -5,7 +5,8 @@
 
 	By Pratik Munot | 30 June 2018
 
-	Dependent modules/library: BeautifulSoup, requests
+	Dependent modules/library: requests, rapidfuzz, numpy, orjson, selectolax
+	Optional: requests_cache, caches the IMDB responses on disk
 
 	USAGE:
 	-----------------------------------------------------------------------
@@ -14,24 +15,64 @@
 	>>> results = imdb_suggest.search('Captain')
 """
 
-import json
+import collections
+import concurrent.futures
+import functools
+import heapq
 import logging
+import operator
 import pprint
 import string
 import sys
 import unicodedata
 import warnings
 
-import bs4 as bs
+import orjson
 import requests
+from rapidfuzz import fuzz, process
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
+from urllib3.util.retry import Retry
+
+try:
+	import requests_cache
+except ImportError:
+	requests_cache = None
 
 #Constants
-MAX_TRY_COUNT = 3
 DECREMENT_QUERY_LEN = [15, 10, 5]
 IMDB_SUGGESTS_URL = 'https://v2.sg.media-imdb.com/suggests/'
 IMDB_TITLE_URL = 'https://www.imdb.com/title/'
+CLEAN_CACHE_SIZE = 4096
+POOL_SIZE = 10
+HTTP_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.2
+HTTP_TIMEOUT = (3, 10)
+ADDITIONAL_INFO_WORKERS = 8
+CACHE_NAME = 'imdb_suggest'
+CACHE_EXPIRE_AFTER = 86400
+SEARCH_CACHE_SIZE = 256
+VALID_CHARS = frozenset(string.ascii_letters + string.digits + '_' + ' ')
+DELETE_TABLE = dict.fromkeys(i for i in range(256) if chr(i) not in VALID_CHARS)
 
 #other setup
+logger = logging.getLogger(__name__)
+
+class AsciiFoldTable(dict):
+	"""
+		str.translate table mapping every character to the ASCII part of
+		its NFKD decomposition, e.g. é -> e. Entries are computed on first
+		use and kept, so each character is only decomposed once.
+	"""
+
+	def __missing__(self, codepoint):
+		decomposed = unicodedata.normalize('NFKD', chr(codepoint))
+		folded = decomposed.encode('ASCII', 'ignore').decode() or None
+		self[codepoint] = folded
+		return folded
+
+ASCII_FOLD_TABLE = AsciiFoldTable()
+
 def warning_on_one_line(message, category, filename, lineno, file=None, line=None):
     return '{0} {1}: {2}: {3}\n'.format('[Warning]', lineno, category.__name__, message)
 
@@ -55,10 +96,29 @@ class IMDBSuggestion(object):
 		self.orginal_query = ''
 		self.imdb_json_response = {}
 		self.fetch_additional_details = False
-		self.valid_chars = string.ascii_letters + string.digits + '_' + ' '
+		self.rank_by_match = False
+		self._search_cache = collections.OrderedDict()
+
+		#reuse the connections to IMDB across searches instead of doing
+		#a new TCP+TLS handshake for every request. When requests_cache
+		#is installed, the responses are also kept on disk so repeated
+		#queries do not hit the network at all
+		if requests_cache is not None:
+			self._session = requests_cache.CachedSession(
+								cache_name=CACHE_NAME,
+								backend='sqlite',
+								expire_after=CACHE_EXPIRE_AFTER)
+		else:
+			self._session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=POOL_SIZE,
+							pool_maxsize=POOL_SIZE,
+							max_retries=Retry(total=HTTP_RETRIES,
+										backoff_factor=HTTP_BACKOFF_FACTOR))
+		self._session.mount('http://', adapter)
+		self._session.mount('https://', adapter)
 		
 	def search(self, query, category='All', top=99, 
-			fetch_additional_details=False, debug=False):
+			fetch_additional_details=False, debug=False, rank_by_match=False):
 		"""
 			Search function will lookup the query and return the results:
 
@@ -68,6 +128,8 @@ class IMDBSuggestion(object):
 				top: return no. of results. Top should be greater than 0
 				fetch_additional_details: True if fetches rating and genre
 				debug: True if debugging has to be turned on else False
+				rank_by_match: True to return the top results with the
+					highest match percent instead of in IMDB's order
 
 			Returns:
 				Array of IMDBSearchResult objects if found else []
@@ -86,18 +148,27 @@ class IMDBSuggestion(object):
 		#check for top is position and greater than 0. if not, throw a 
 		#warning and set it to 99
 		if top <= 0:
-			logging.warn('Top should be greater than 0, returning all results')
+			logger.warning('Top should be greater than 0, returning all results')
 			top = 99
 
 		self.debug = debug
 		self.top = top
 		self.fetch_additional_details = fetch_additional_details
+		self.rank_by_match = rank_by_match
 		
 		#clean the query - the API only accepts characters, underscores,
 		#space and numbers. Replace accented chars, strip special chars.
 		#The API only takes in 20 characters as input
 		query = self._clean_string(query)
 
+		#identical searches return the same results, serve them from
+		#memory instead of fetching and parsing them again
+		cache_key = (query.lower(), category, top, fetch_additional_details,
+					rank_by_match)
+		if cache_key in self._search_cache:
+			self._search_cache.move_to_end(cache_key)
+			return list(self._search_cache[cache_key])
+
 		#stored the stripped version of query for later use
 		self.orginal_query = self.query = query.lower()
 		self.query = self.query[:20].replace(' ', '_')
@@ -106,46 +177,75 @@ class IMDBSuggestion(object):
 		#as numbers. It accepts _ as well
 		char_index = self.query[0]
 
-		#generate the URL and get response
-		try_count = 0
-		while True:
-			request_url = (IMDB_SUGGESTS_URL 
-						+ cat_path 
-						+ char_index + '/' 
-						+ self.query + '.json')
-			
-			print('Requested URL: {}'.format(request_url))
-
-			try:
-				response = requests.get(request_url)
-			except requests.exceptions.RequestException as e:
-				logging.error('[ERROR] Bad URL recieved or timeout occured.'
-								'Retry after some time')
-				logging.debug(e)
-
-			#parse the response
-			search_results = self._parse_result(response.text)
-
-			#check the lenght of the query..if less than decrement
-			#query length, then exclude those options
-			if len(search_results) == 0 and try_count < MAX_TRY_COUNT:
-				while True:
-					#if lenght of the query is already less than first
-					#decrement, go for the next decemental length
-					if len(self.query) < DECREMENT_QUERY_LEN[try_count] and \
-						try_count < MAX_TRY_COUNT:
-						try_count += 1
-					else:
-						break
-
-				self.query = self.query[:DECREMENT_QUERY_LEN[try_count]]
-			else:
-				break
-
-			try_count += 1
+		#the API returns nothing when a long query does not match, so
+		#shorter versions of the query are used as fallbacks. Rather than
+		#trying them one after the other, request all of them at once and
+		#keep the longest query that returns results
+		candidates = [self.query]
+		candidates += [self.query[:length] for length in DECREMENT_QUERY_LEN
+						if length < len(self.query)]
+
+		executor = concurrent.futures.ThreadPoolExecutor(
+						max_workers=len(candidates))
+		futures = [executor.submit(self._fetch_response, 
+								IMDB_SUGGESTS_URL 
+								+ cat_path 
+								+ char_index + '/' 
+								+ candidate + '.json')
+					for candidate in candidates]
+
+		search_results = []
+		try:
+			for candidate, future in zip(candidates, futures):
+				try:
+					response = future.result()
+				except requests.exceptions.RequestException as e:
+					logger.error('[ERROR] Bad URL recieved or timeout occured.'
+									'Retry after some time')
+					logger.debug(e)
+					continue
+
+				#parse the response
+				self.query = candidate
+				search_results = list(self._parse_result(response))
+				if len(search_results) > 0:
+					break
+		finally:
+			#the shorter queries are not needed once a result is found
+			executor.shutdown(wait=False, cancel_futures=True)
+
+		#all the suggestions are parsed when ranking, only the best top
+		#ones need to be ordered
+		if self.rank_by_match:
+			search_results = heapq.nlargest(self.top, search_results,
+								key=operator.attrgetter('match_percent'))
+
+		self.imdb_results = search_results
+
+		#the title pages are independent of each other, fetch them
+		#concurrently rather than one round trip after the other
+		if self.fetch_additional_details:
+			with concurrent.futures.ThreadPoolExecutor(
+					max_workers=ADDITIONAL_INFO_WORKERS) as executor:
+				list(executor.map(IMDBSearchResult.get_additional_info,
+								search_results))
+
+		if len(search_results) > 0:
+			self._search_cache[cache_key] = list(search_results)
+			if len(self._search_cache) > SEARCH_CACHE_SIZE:
+				self._search_cache.popitem(last=False)
 
 		return search_results
 
+	def _fetch_response(self, request_url):
+		"""
+			Requests the url using the shared session and returns the 
+			raw response bytes.
+		"""
+		logger.debug('Requested URL: %s', request_url)
+		response = self._session.get(request_url, timeout=HTTP_TIMEOUT)
+		return response.content
+
 	def _parse_result(self, response):
 		"""
 			To parse the response from the suggestion API. The response
@@ -153,83 +253,78 @@ class IMDBSuggestion(object):
 			imdb$<query>(<json output>). 
 
 			Args:
-				repsonse: raw response returned from the API
+				repsonse: raw response bytes returned from the API
 				
-			Returns:
-				json object for the search results
+			Yields:
+				IMDBSearchResult for each suggestion, built lazily
 		"""
 
 		#reset the variables when parse is called
-		self.imdb_results = []
 		self.imdb_json_response = {}
 
 		#Remove the javascript function imdb$<search query>(  ) 
-		#from the response
+		#from the response. The query is plain ASCII, so slicing the
+		#bytes directly is safe and saves decoding the whole response
 		start_pos = len('imdb$') + len(self.query) + 1
-		response =  response[start_pos:-1]
 
-		#if no search results are return, return an empty array
-		try:
-			self.imdb_json_response = json.loads(response)['d']
-		except Exception as e:
-			logging.warn('No search results returned. Attempting to fetch'
+		#if no search results are return, the response has no 'd' key.
+		#Check for it before parsing rather than relying on an exception
+		if b'"d":' not in response:
+			logger.warning('No search results returned. Attempting to fetch'
 						' results for shorter query.')
-			return self.imdb_results 
+			return
+
+		try:
+			self.imdb_json_response = orjson.loads(response[start_pos:-1]).get('d', [])
+		except orjson.JSONDecodeError as e:
+			logger.error('[ERROR] Could not parse the response from the API')
+			logger.debug(e)
+			return
 
 		if self.debug: 
 			self.print_json_dump()
 
-		for idx, suggestion in enumerate(self.imdb_json_response):
-			if self.top != -1 and idx > self.top:
-				break
+		#make a compare of title returned and actaual..the example is 
+		#Once upon a time in AMerica/in West. Only the top suggestions are
+		#parsed, unless they are to be ranked by match percent, and their
+		#labels are scored against the query in a single call
+		if self.rank_by_match:
+			suggestions = self.imdb_json_response
+		else:
+			suggestions = self.imdb_json_response[:self.top]
+		labels = [self._clean_string(suggestion['l']).lower() 
+					for suggestion in suggestions]
+		scores = process.cdist([self.orginal_query], labels,
+							scorer=fuzz.ratio)[0]
 
+		for idx, (suggestion, score) in enumerate(zip(suggestions, scores)):
 			#not all json attributes are returned based on the category
-			#of the search results. As a precaution, setting them to 
+			#of the search results. As a precaution, falling back to a 
 			#default value, in case they dont exists
-			suggestion.setdefault('y',0)
-			suggestion.setdefault('q','unknown')
-
-			#make a compare of title returned and actaual..the example is 
-			#Once upon a time in AMerica/in West 
-			match_percent = self._compare_string(self.orginal_query, suggestion['l'])
-
-			suggestion = IMDBSearchResult(suggestion['id'],
-									suggestion['l'],
-								 	suggestion['y'],
-								 	suggestion['q'], 
-								 	idx + 1,
-								 	match_percent,
-								 	self.fetch_additional_details)
-			self.imdb_results.append(suggestion)
-			
-		return self.imdb_results
-
-	def _compare_string(self, string1, string2):
-		"""
-			the function compares the two strings and returns the 
-			percentage match.
-		"""
-		x = string1
-		y = self._clean_string(string2).lower()
-		max_length = max(len(x), len(y))
-
-		match_char_cnt = 0
-		for i,j in zip(x, y):
-			if i == j:
-				match_char_cnt += 1
-
-		return round((match_char_cnt/max_length) * 100, 2)
-
-	def _clean_string(self, input):
+			year = suggestion.get('y', 0)
+			category = suggestion.get('q', 'unknown')
+
+			match_percent = round(float(score), 2)
+
+			yield IMDBSearchResult(suggestion['id'],
+								suggestion['l'],
+								year,
+								category,
+								idx + 1,
+								match_percent,
+								session=self._session)
+
+	@staticmethod
+	@functools.lru_cache(maxsize=CLEAN_CACHE_SIZE)
+	def _clean_string(input):
 		"""
 			returns cleaned string.  
 			The accented charcters are converted to normal english char 
 			and all chacters except strings,numbers, underscore and space
-			are stripped.
+			are stripped. Results are cached as the same labels keep
+			coming back for every search.
 		"""
-		str_encode = unicodedata.normalize('NFKD', input).encode('ASCII', 'ignore')
-		str_decode = str_encode.decode()
-		return ''.join(c for c in str_decode if c in self.valid_chars)
+		return input.translate(ASCII_FOLD_TABLE).translate(DELETE_TABLE)
 
 	def print_json_dump(self):
 		#pretty printing the json with depth as 3
@@ -242,8 +337,11 @@ class IMDBSearchResult(object):
 		percent attribute is also added. User can refer to this percentage
 	"""
 
+	__slots__ = ('id', 'label', 'year', 'category', 'idx', 'genre', 'rating',
+				'match_percent', 'type', '_session')
+
 	def __init__(self, id, l, y , q, idx, 
-				match_percent, fetch_additional_details=False):
+				match_percent, fetch_additional_details=False, session=None):
 		self.id = id
 		self.label = l
 		self.year = y
@@ -253,6 +351,7 @@ class IMDBSearchResult(object):
 		self.rating = 0.0
 		self.match_percent = match_percent
 		self.type = ''
+		self._session = session
 
 		if self.id.startswith('nm'): 
 			self.type = 'Actor'
@@ -260,22 +359,23 @@ class IMDBSearchResult(object):
 			self.type ='Title'
 
 		if fetch_additional_details:
-			self._get_additional_info()
+			self.get_additional_info()
 
-	def _get_additional_info(self):
+	def get_additional_info(self):
 		"""
 			Fetch the rating and genre of the title passed. 
 			No results will be fetched for any other category.
 		"""
 		if self.id.startswith('tt'):
 			url = IMDB_TITLE_URL + self.id
-			print('Request url for IMDB title search: {}'.format(url))
+			logger.debug('Request url for IMDB title search: %s', url)
 			try:
-				response = requests.get(url)
-				if debug: pprint.pprint(repsonse)
-				body = bs.BeautifulSoup(response.text, 'html.parser')
-				self.rating = body.find('div', class_='ratingValue').strong.span.text
-				self.genre = [t.text for t in body.find_all('span', itemprop='genre')]
+				http = self._session or requests
+				response = http.get(url, timeout=HTTP_TIMEOUT)
+				logger.debug('Response for %s: %s', url, response)
+				body = LexborHTMLParser(response.text)
+				self.rating = body.css_first('div.ratingValue strong span').text()
+				self.genre = [t.text() for t in body.css('span[itemprop="genre"]')]
 			except Exception as e:
 				warnings.warn('Error occured while fetching additional details.'
 					  'Check the URL/repsonse. Continuing with other requests')